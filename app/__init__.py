@@ -1,58 +1,265 @@
 from flask import Flask
+from flask.json.provider import DefaultJSONProvider
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime, timedelta
+from sqlalchemy.exc import SQLAlchemyError
+from datetime import datetime
+import functools
+import hashlib
+import heapq
+import logging
 import os
+import re
 from collections import deque
+import queue
 import threading
 import time
 import subprocess
 import shutil
-import traceback
 import socket
-from concurrent.futures import ThreadPoolExecutor
+import uuid
+import yaml
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import orjson
+except ImportError:  # Responses fall back to Flask's standard json provider
+    orjson = None
 
 # Configuration
 JOB_EXPIRATION_MINUTES = 120  # Time after which jobs are deleted
-MAX_CONCURRENT_JOBS = 3  # Maximum number of jobs that can run simultaneously
+CLEANUP_INTERVAL_SECONDS = 300  # Longest the cleanup thread sleeps between checks
+TRASH_DIR = os.path.join('workspace', '.trash')  # Staging area for workspaces awaiting deletion
+LOG_DIR = os.path.join('workspace', '.logs')  # Full container output, one file per job
+PIP_CACHE_DIR = os.path.join('workspace', '.pip-cache')  # pip wheel caches, one per repository
+MAX_LOG_LINES = 10000  # Most recent log lines shown on the job page
+LOG_WINDOW_BYTES = 1024 * 1024  # Most log output read from disk per request
+MAX_CONCURRENT_JOBS = int(os.environ.get('JOB_CONCURRENCY', 3))  # Maximum number of jobs that can run simultaneously
+DOCKER_CHECK_TTL = 30.0  # Seconds to trust a successful check_docker_running
+CONTAINER_STATE_TTL = 1.0  # Seconds to reuse a 'docker inspect' of a job container's state
+DOCKER_DOWN_RECHECK = 5.0  # Seconds before a failed Docker check is retried
+LOCAL_IMAGES_TTL = 60.0  # Seconds to reuse a 'docker images' listing
+IMAGE_PULL_TIMEOUT = 1800  # Seconds a job waits for another thread's pull of its image
+CONTAINER_GC_INTERVAL = 5.0  # Seconds to collect container removals into one batch
+MAX_PORT_ATTEMPTS = 5  # docker run attempts for a web app whose host port is taken
+CLONE_TIMEOUT_SECONDS = 300  # Longest a repository clone may take before the job fails
+DOCKER_EVENTS_RETRY = 5.0  # Seconds before reconnecting a closed 'docker events' stream
+
+logger = logging.getLogger(__name__)
 
 db = SQLAlchemy()
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider that serializes and parses with orjson."""
+    
+    def dumps(self, obj, **kwargs):
+        # Options orjson has no equivalent for are left to the standard encoder
+        if kwargs.keys() - {'sort_keys', 'separators'}:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        # The session serializer passes an object_hook to restore tagged values
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+class Job(db.Model):
+    """Persisted job metadata; app.jobs_metadata holds the live copy and logs stay in LOG_DIR."""
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.String(36), primary_key=True)
+    repo_url = db.Column(db.String, nullable=False)
+    branch = db.Column(db.String, nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    timestamp = db.Column(db.String(32), nullable=False)
+    created_at_ts = db.Column(db.Float, nullable=False)
+    is_web = db.Column(db.Boolean, default=False)
+    container_port = db.Column(db.Integer)
+    docker_workspace_dir = db.Column(db.String)
+    framework = db.Column(db.String(16))
+    exit_code = db.Column(db.Integer)
+    start_time = db.Column(db.Float)
+    end_time = db.Column(db.Float)
+    
+    FIELDS = ('id', 'repo_url', 'branch', 'status', 'timestamp', 'created_at_ts', 'is_web',
+              'container_port', 'docker_workspace_dir', 'framework', 'exit_code', 'start_time', 'end_time')
+    
+    @classmethod
+    def from_metadata(cls, job):
+        return cls(**{name: job.get(name) for name in cls.FIELDS})
+    
+    def to_metadata(self):
+        # The host port belonged to a container of a previous run
+        job = {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+        job['host_port'] = None
+        for field in ('start_time', 'end_time'):
+            if field in job:
+                set_job_time(job, field, job[field])
+        return job
+
+def set_job_time(job, field, timestamp=None):
+    """Set a job's start_time or end_time (default now) and its ISO form for display."""
+    if timestamp is None:
+        timestamp = time.time()
+    job[field] = timestamp
+    job[f'{field}_iso'] = datetime.fromtimestamp(timestamp).isoformat()
+
 job_semaphore = threading.Semaphore(MAX_CONCURRENT_JOBS)
+_docker_ok_cache = (float('-inf'), False)  # (monotonic time of last check, daemon running)
+_docker_check_lock = threading.Lock()
+_pulled_images = set()  # Base images known to be present locally
+_pulled_images_lock = threading.Lock()
+_image_pulls = {}  # image -> threading.Event set when the in-flight pull finishes
+_local_images_checked_at = float('-inf')  # monotonic time of the last 'docker images' listing
+_container_states = {}  # container name -> (monotonic time of last inspect, running)
+_container_inspects = {}  # container name -> threading.Event set when the in-flight inspect finishes
+_container_states_lock = threading.Lock()
 
 def check_docker_running():
-    """Check if Docker daemon is running."""
+    """Check if Docker daemon is running, reusing a recent answer."""
+    # A healthy daemon is trusted for DOCKER_CHECK_TTL seconds; a failed check
+    # is retried sooner so jobs recover quickly once Docker starts
+    global _docker_ok_cache
+    with _docker_check_lock:
+        checked_at, running = _docker_ok_cache
+        ttl = DOCKER_CHECK_TTL if running else DOCKER_DOWN_RECHECK
+        if time.monotonic() - checked_at < ttl:
+            return running
+        
+        # 'docker version' with only the server field is much lighter than
+        # 'docker info', and the output isn't needed at all
+        try:
+            subprocess.run(
+                ['docker', 'version', '--format', '{{.Server.Version}}'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True
+            )
+            running = True
+        except subprocess.CalledProcessError:
+            running = False
+        except FileNotFoundError:
+            running = False
+        
+        _docker_ok_cache = (time.monotonic(), running)
+        return running
+
+def run_once_in_flight(in_flight, lock, key, func, timeout=None):
+    """Run func() unless a call for key is already running, else wait for that one; returns (ran, result)."""
+    with lock:
+        done = in_flight.get(key)
+        is_owner = done is None
+        if is_owner:
+            done = in_flight[key] = threading.Event()
+    
+    if not is_owner:
+        done.wait(timeout=timeout)
+        return False, None
+    
     try:
-        subprocess.run(['docker', 'info'], capture_output=True, check=True)
-        return True
-    except subprocess.CalledProcessError:
-        return False
-    except FileNotFoundError:
-        return False
+        return True, func()
+    finally:
+        with lock:
+            del in_flight[key]
+        done.set()
 
-def detect_framework(job_path):
-    """Detect the ML framework used in the project based on dependencies."""
-    # Check for requirements.txt
-    req_path = os.path.join(job_path, 'requirements.txt')
-    if os.path.exists(req_path):
-        with open(req_path, 'r') as f:
-            content = f.read().lower()
-            if 'torch' in content or 'pytorch' in content:
-                return 'pytorch'
-            if 'tensorflow' in content:
-                return 'tensorflow'
-    
-    # Check for environment.yml
-    env_path = os.path.join(job_path, 'environment.yml')
-    if os.path.exists(env_path):
-        with open(env_path, 'r') as f:
-            content = f.read().lower()
-            if 'torch' in content or 'pytorch' in content:
-                return 'pytorch'
-            if 'tensorflow' in content:
-                return 'tensorflow'
+def _cached_container_state(container_name):
+    """Return a container's recently inspected running state, or None if there isn't one."""
+    with _container_states_lock:
+        cached = _container_states.get(container_name)
+    if cached and time.monotonic() - cached[0] < CONTAINER_STATE_TTL:
+        return cached[1]
+    return None
+
+def _inspect_container(container_name):
+    """Ask Docker whether a container is running and cache the answer."""
+    result = subprocess.run(
+        ['docker', 'inspect', '--format', '{{.State.Running}}', container_name],
+        capture_output=True, text=True
+    )
+    running = result.returncode == 0 and result.stdout.strip() == 'true'
+    
+    with _container_states_lock:
+        # Forget stale answers so removed containers don't accumulate
+        now = time.monotonic()
+        for name in [name for name, (checked_at, _) in _container_states.items()
+                     if now - checked_at >= CONTAINER_STATE_TTL]:
+            del _container_states[name]
+        _container_states[container_name] = (now, running)
+    return running
+
+def is_container_running(container_name):
+    """Check if a container is running, reusing an answer for CONTAINER_STATE_TTL seconds."""
+    running = _cached_container_state(container_name)
+    if running is not None:
+        return running
+    
+    # While a web app is down every proxied request asks, so requests for the
+    # same container share one 'docker inspect'
+    ran, running = run_once_in_flight(_container_inspects, _container_states_lock, container_name,
+                                      functools.partial(_inspect_container, container_name))
+    if ran:
+        return running
+    
+    # Another request just inspected it; if that failed, inspect it here once
+    running = _cached_container_state(container_name)
+    return running if running is not None else _inspect_container(container_name)
+
+_FRAMEWORK_RE = re.compile(rb'torch|tensorflow', re.IGNORECASE)
+
+def _file_mtime(path):
+    """Return the modification time of path in nanoseconds, or None if it is missing."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def _scan_dependency_file(path):
+    """Return the framework referenced by a dependency file, or None."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    framework = None
+    for match in _FRAMEWORK_RE.finditer(data):
+        if match.group().lower() == b'torch':  # Also matches 'pytorch'
+            return 'pytorch'  # PyTorch wins, so there's no need to scan further
+        framework = 'tensorflow'
+    return framework
+
+@functools.lru_cache(maxsize=256)
+def _detect_framework(job_path, requirements_mtime, environment_mtime):
+    """Cached framework detection keyed on the dependency files' mtimes."""
+    for filename, mtime in (('requirements.txt', requirements_mtime), ('environment.yml', environment_mtime)):
+        if mtime is not None:
+            framework = _scan_dependency_file(os.path.join(job_path, filename))
+            if framework:
+                return framework
     
     # Default to Python if no specific framework is detected
     return 'python'
 
+def _entry_mtime(entries, filename):
+    """Return the modification time of a scanned directory entry, or None if it is absent."""
+    entry = entries.get(filename)
+    return entry.stat().st_mtime_ns if entry is not None else None
+
+def detect_framework(job_path, entries=None):
+    """Detect the ML framework used in the project based on dependencies."""
+    # entries, if given, maps names to os.DirEntry objects from an existing scan
+    # of job_path, so files that aren't there cost no stat call
+    if entries is None:
+        return _detect_framework(
+            job_path,
+            _file_mtime(os.path.join(job_path, 'requirements.txt')),
+            _file_mtime(os.path.join(job_path, 'environment.yml'))
+        )
+    return _detect_framework(
+        job_path,
+        _entry_mtime(entries, 'requirements.txt'),
+        _entry_mtime(entries, 'environment.yml')
+    )
+
 def is_wsl():
     """Check if running under Windows Subsystem for Linux."""
     try:
@@ -64,18 +271,18 @@ def is_wsl():
 def has_rocm():
     """Check if ROCm is available on the system."""
     try:
-        subprocess.run(['rocminfo'], capture_output=True, check=True)
+        subprocess.run(['rocminfo'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
         return True
     except (subprocess.CalledProcessError, FileNotFoundError):
         return False
 
-def get_base_image(framework):
-    """Get the appropriate Docker base image for the framework."""
+def get_image_options():
+    """Get the primary and fallback Docker images for each framework."""
     # Check if we're in WSL2 and have ROCm available
     is_rocm_available = is_wsl() and has_rocm()
     
     # Define images with fallbacks
-    images = {
+    return {
         'pytorch': {
             'primary': 'rocm/pytorch:latest' if is_rocm_available else 'pytorch/pytorch:2.1.0-cuda11.8-cudnn8-runtime',
             'fallback': 'python:3.10-slim'
@@ -89,30 +296,117 @@ def get_base_image(framework):
             'fallback': 'python:3.10-slim'
         }
     }
+
+def refresh_local_images():
+    """Add every locally available image to _pulled_images using a single 'docker images' call."""
+    global _local_images_checked_at
+    with _pulled_images_lock:
+        if time.monotonic() - _local_images_checked_at < LOCAL_IMAGES_TTL:
+            return
+        _local_images_checked_at = time.monotonic()
+        try:
+            result = subprocess.run(
+                ['docker', 'images', '--format', '{{.Repository}}:{{.Tag}}'],
+                capture_output=True, text=True, check=True
+            )
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            return
+        _pulled_images.update(result.stdout.split())
+
+def _pull_image(image):
+    """Pull a Docker image and record it as present locally."""
+    # Images left over from a previous run don't need a registry round-trip
+    refresh_local_images()
+    if image in _pulled_images:
+        return True
     
+    try:
+        # The progress output is discarded rather than buffered in memory
+        subprocess.run(['docker', 'pull', image], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+    
+    with _pulled_images_lock:
+        _pulled_images.add(image)
+    return True
+
+def pull_image(image):
+    """Pull a Docker image unless it is already known to be present locally."""
+    if image in _pulled_images:
+        return True
+    
+    # A job that starts while the prewarm thread is pulling its image waits
+    # for that pull instead of starting a second download
+    ran, pulled = run_once_in_flight(_image_pulls, _pulled_images_lock, image,
+                                     functools.partial(_pull_image, image), timeout=IMAGE_PULL_TIMEOUT)
+    return pulled if ran else image in _pulled_images
+
+def prewarm_images():
+    """Pull every base image in parallel so the first job of each kind doesn't wait on a pull."""
+    if not check_docker_running():
+        logger.warning("Docker is not running, skipping base image pre-pull")
+        return
+    
+    images = {image for config in get_image_options().values() for image in config.values()}
+    with ThreadPoolExecutor(max_workers=len(images), thread_name_prefix='prewarm') as pool:
+        for image, pulled in zip(images, pool.map(pull_image, images)):
+            logger.info("Pre-pull of %s %s", image, 'succeeded' if pulled else 'failed')
+
+def get_base_image(framework):
+    """Get the appropriate Docker base image for the framework."""
     # Get the appropriate image configuration
+    images = get_image_options()
     image_config = images.get(framework, images['python'])
     
-    # Try to pull the primary image
-    try:
-        subprocess.run(['docker', 'pull', image_config['primary']], check=True, capture_output=True)
+    # Try to pull the primary image (a no-op once it has been pulled)
+    if pull_image(image_config['primary']):
         return image_config['primary']
-    except subprocess.CalledProcessError:
-        print(f"Warning: Failed to pull {image_config['primary']}, falling back to {image_config['fallback']}")
-        return image_config['fallback']
+    logger.warning("Failed to pull %s, falling back to %s", image_config['primary'], image_config['fallback'])
+    return image_config['fallback']
 
 def create_app():
     app = Flask(__name__)
     app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev')
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///app.db')
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Let a front-end server that honours X-Sendfile transfer downloads itself
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+    # Or let nginx do it through X-Accel-Redirect to its internal /internal-workspace/ location
+    app.config['USE_XACCEL'] = os.environ.get('USE_XACCEL') == '1'
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
     
     # Initialize extensions
     db.init_app(app)
     
+    # Expired workspaces are moved here and deleted in the background
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    os.makedirs(PIP_CACHE_DIR, exist_ok=True)
+    
     # Initialize job tracking
     app.jobs_metadata = {}
-    app.job_queue = []
+    app.jobs_lock = threading.RLock()  # Guards job metadata shared across worker threads
+    app.expiry_heap = []  # (expire_at, job_id) min-heap read by the cleanup thread
+    app.expiry_lock = threading.Lock()
+    app.job_queue = queue.Queue()
+    app.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix='job')
+    app.cleanup_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='cleanup')
+    app.containers_to_gc = queue.Queue()  # Container names waiting for a batched 'docker rm -f'
+    app.running_containers = None  # Names of running job containers, kept by watch_container_events
+    
+    # Finish deleting anything a previous run moved to the trash but didn't get to
+    for entry in os.listdir(TRASH_DIR):
+        app.cleanup_pool.submit(remove_directory, os.path.join(TRASH_DIR, entry))
+    
+    # Create the jobs table and restore jobs from a previous run; WAL lets
+    # request threads read while job threads write
+    with app.app_context():
+        db.create_all()
+        if db.engine.dialect.name == 'sqlite':
+            with db.engine.connect() as conn:
+                conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+    load_jobs(app)
     
     # Register blueprints
     from app.routes import main
@@ -122,12 +416,76 @@ def create_app():
     worker_thread = threading.Thread(target=background_worker, args=(app,), daemon=True)
     worker_thread.start()
     
+    # Pull base images in the background so they're warm before the first job
+    prewarm_thread = threading.Thread(target=prewarm_images, daemon=True)
+    prewarm_thread.start()
+    
     # Start cleanup thread
     cleanup_thread = threading.Thread(target=cleanup_old_jobs, args=(app,), daemon=True)
     cleanup_thread.start()
     
+    # Start container garbage collector
+    container_gc_thread = threading.Thread(target=container_gc, args=(app,), daemon=True)
+    container_gc_thread.start()
+    
+    # Follow container start/die events instead of inspecting containers on demand
+    events_thread = threading.Thread(target=watch_container_events, args=(app,), daemon=True)
+    events_thread.start()
+    
     return app
 
+def save_job(app, job):
+    """Write a job's metadata through to the database."""
+    # A worker may still hold a job that cleanup removed; saving it would
+    # bring the row back. The lock is held through the write so cleanup
+    # can't delete the row in between
+    with app.jobs_lock:
+        if app.jobs_metadata.get(job['id']) is not job:
+            return
+        row = Job.from_metadata(job)
+        try:
+            with app.app_context():
+                db.session.merge(row)
+                db.session.commit()
+        except SQLAlchemyError as e:
+            logger.error("Error saving job %s: %s", row.id, e)
+
+def delete_job(app, job_id):
+    """Remove a job's row from the database."""
+    try:
+        with app.app_context():
+            Job.query.filter_by(id=job_id).delete()
+            db.session.commit()
+    except SQLAlchemyError as e:
+        logger.error("Error deleting job %s: %s", job_id, e)
+
+def load_jobs(app):
+    """Restore the jobs saved by a previous run into app.jobs_metadata."""
+    with app.app_context():
+        jobs = [row.to_metadata() for row in Job.query.order_by(Job.created_at_ts)]
+    
+    for job in jobs:
+        app.jobs_metadata[job['id']] = job
+        schedule_job_expiry(app, job['id'], job['created_at_ts'])
+        if job['status'] == 'Queued':
+            app.job_queue.put(job['id'])
+        elif job['status'] in ('Cloning', 'Running'):
+            # Cut off part way when the server stopped
+            job['status'] = 'Failed'
+            set_job_time(job, 'end_time')
+            append_job_logs(app, job['id'], "Job failed: the server stopped while it was running")
+            save_job(app, job)
+    if jobs:
+        logger.info("Restored %d jobs from the database", len(jobs))
+
+def job_log_path(job_id):
+    """Get the path of the file holding a job's full container output."""
+    return os.path.join(LOG_DIR, f'{job_id}.log')
+
+def pip_cache_path(repo_url):
+    """Get the pip cache directory shared by the jobs of one repository."""
+    return os.path.join(PIP_CACHE_DIR, hashlib.sha256(repo_url.rstrip('/').encode()).hexdigest()[:16])
+
 def remove_readonly(func, path, _):
     """Clear the readonly bit and reattempt the removal."""
     try:
@@ -135,199 +493,487 @@ def remove_readonly(func, path, _):
         os.chmod(path, 0o777)
         func(path)
     except Exception as e:
-        print(f"Error in remove_readonly: {str(e)}")
+        logger.error("Error in remove_readonly: %s", e)
         raise
 
+def remove_directory_native(directory):
+    """Remove a directory tree with the platform's own tool; returns True on success."""
+    if os.name == 'nt':
+        cmd = ['cmd', '/c', 'rmdir', '/S', '/Q', directory]
+    else:
+        cmd = ['rm', '-rf', directory]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+    return not os.path.exists(directory)
+
+def remove_directory_fwalk(directory):
+    """Remove a directory tree in a single bottom-up pass using dir_fd-relative calls."""
+    for _, dirnames, filenames, dirfd in os.fwalk(directory, topdown=False):
+        made_writable = False
+        for name, remove in [(n, os.unlink) for n in filenames] + [(n, os.rmdir) for n in dirnames]:
+            try:
+                try:
+                    remove(name, dir_fd=dirfd)
+                except NotADirectoryError:
+                    # Symlinks to directories are listed as dirnames but not followed
+                    os.unlink(name, dir_fd=dirfd)
+            except PermissionError:
+                if made_writable:
+                    raise
+                # Entries can only be removed from a writable directory; fix
+                # that once for the whole directory rather than per entry
+                os.chmod(dirfd, 0o700)
+                made_writable = True
+                remove(name, dir_fd=dirfd)
+    os.rmdir(directory)
+
 def remove_directory(directory):
     """Remove a directory and all its contents, handling read-only files."""
     try:
         if os.path.exists(directory):
-            print(f"Attempting to remove directory: {directory}")
-            shutil.rmtree(directory, onerror=remove_readonly)
-            print(f"Successfully removed directory: {directory}")
+            logger.debug("Attempting to remove directory: %s", directory)
+            # The native tool is much faster on trees with many small files;
+            # the Python fallbacks handle the read-only files it may leave behind
+            if not remove_directory_native(directory):
+                logger.debug("Native removal of %s failed, falling back to Python removal", directory)
+                if hasattr(os, 'fwalk'):
+                    try:
+                        remove_directory_fwalk(directory)
+                    except OSError:
+                        shutil.rmtree(directory, onerror=remove_readonly)
+                else:  # Windows
+                    shutil.rmtree(directory, onerror=remove_readonly)
+            logger.debug("Successfully removed directory: %s", directory)
             return True
     except Exception as e:
-        print(f"Error removing directory {directory}: {str(e)}")
+        logger.error("Error removing directory %s: %s", directory, e)
         return False
 
+def discard_directory(directory):
+    """Move a directory into the trash area and delete it in the background."""
+    trash_path = os.path.join(TRASH_DIR, uuid.uuid4().hex)
+    try:
+        os.rename(directory, trash_path)
+    except OSError as e:
+        logger.warning("Could not move %s to trash: %s", directory, e)
+        return False
+    
+    if os.name == 'nt':
+        threading.Thread(target=remove_directory, args=(trash_path,), daemon=True).start()
+    else:
+        subprocess.Popen(['rm', '-rf', trash_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return True
+
+def _cleanup_one_job(app, job_id):
+    """Remove the metadata and workspace of a single expired job."""
+    logger.debug("Processing cleanup for job %s", job_id)
+    
+    # Remove job metadata
+    with app.jobs_lock:
+        job = app.jobs_metadata.pop(job_id, None)
+        if job is not None:
+            logger.debug("Removed metadata for job %s", job_id)
+    delete_job(app, job_id)
+    
+    # Containers are started with --rm, so only one that is still running
+    # (e.g. a web app) needs to be stopped before its workspace goes away
+    container_name = f"job_{job_id}"
+    running = app.running_containers
+    if running is not None:
+        if container_name in running:
+            app.containers_to_gc.put(container_name)
+    elif job is not None and job.get('status') == 'Running':
+        app.containers_to_gc.put(container_name)
+    
+    # A job still waiting in the queue is skipped by background_worker
+    # once its metadata is gone, so there's nothing to dequeue here
+    
+    # Remove workspace directory
+    workspace_dir = os.path.join('workspace', job_id)
+    logger.debug("Checking workspace directory: %s", workspace_dir)
+    
+    if os.path.exists(workspace_dir):
+        if discard_directory(workspace_dir):
+            logger.debug("Moved workspace %s to trash", workspace_dir)
+        else:
+            # Fall back to removing the directory in place with retries
+            max_retries = 3
+            for attempt in range(max_retries):
+                if remove_directory(workspace_dir):
+                    break
+                logger.debug("Retry %d/%d for removing directory %s", attempt + 1, max_retries, workspace_dir)
+                time.sleep(1)  # Wait a second before retrying
+    else:
+        logger.debug("Workspace directory %s does not exist", workspace_dir)
+    
+    # Remove the full log file
+    try:
+        os.remove(job_log_path(job_id))
+    except FileNotFoundError:
+        pass
+    
+    logger.info("Cleaned up expired job %s", job_id)
+
+def schedule_job_expiry(app, job_id, created_at_ts):
+    """Record when a newly submitted job should be cleaned up."""
+    expire_at = created_at_ts + JOB_EXPIRATION_MINUTES * 60
+    with app.expiry_lock:
+        heapq.heappush(app.expiry_heap, (expire_at, job_id))
+
+def container_gc(app):
+    """Background thread that force-removes queued containers in batches."""
+    while True:
+        try:
+            # Block until there's work, then give other removals a moment to
+            # queue up so a whole batch goes out in one docker call
+            names = [app.containers_to_gc.get()]
+            time.sleep(CONTAINER_GC_INTERVAL)
+            while True:
+                try:
+                    names.append(app.containers_to_gc.get_nowait())
+                except queue.Empty:
+                    break
+            
+            logger.debug("Removing containers: %s", names)
+            result = subprocess.run(['docker', 'rm', '-f', *names], capture_output=True, text=True)
+            if result.returncode != 0:
+                logger.warning("docker rm -f reported: %s", result.stderr.strip())
+        except Exception as e:
+            logger.exception("Error in container garbage collector: %s", e)
+            time.sleep(5)  # Wait 5 seconds before retrying on error
+
+def watch_container_events(app):
+    """Background thread that tracks running job containers from one 'docker events' stream."""
+    # app.running_containers holds the names of running job containers, or
+    # None while the stream is down and the set can't be trusted
+    while True:
+        try:
+            # Subscribe before listing so a container starting in between isn't missed
+            process = subprocess.Popen(
+                ['docker', 'events', '--filter', 'type=container',
+                 '--filter', 'event=start', '--filter', 'event=die',
+                 '--format', '{{.Action}} {{.Actor.Attributes.name}}'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            )
+            result = subprocess.run(
+                ['docker', 'ps', '--filter', 'name=job_', '--format', '{{.Names}}'],
+                capture_output=True, text=True
+            )
+            if result.returncode == 0:
+                app.running_containers = set(result.stdout.split())
+                for line in process.stdout:
+                    action, _, name = line.strip().partition(' ')
+                    if not name.startswith('job_'):
+                        continue
+                    if action == 'start':
+                        app.running_containers.add(name)
+                    else:
+                        app.running_containers.discard(name)
+            process.kill()
+            process.wait()
+        except FileNotFoundError:
+            pass  # Docker CLI isn't installed
+        except Exception as e:
+            logger.exception("Error in container event watcher: %s", e)
+        
+        app.running_containers = None
+        time.sleep(DOCKER_EVENTS_RETRY)
+
 def cleanup_old_jobs(app):
     """Background thread to clean up old jobs and their files."""
-    print("Cleanup thread started")
+    logger.info("Cleanup thread started")
     while True:
         try:
-            current_time = datetime.now()
+            now = time.time()
             jobs_to_remove = []
             
-            print(f"Checking for old jobs at {current_time}")
-            print(f"Current jobs in metadata: {list(app.jobs_metadata.keys())}")
+            logger.debug("Checking for old jobs at %s", now)
             
-            # Find jobs older than JOB_EXPIRATION_MINUTES
-            for job_id, job in app.jobs_metadata.items():
-                job_time = datetime.fromisoformat(job['timestamp'])
-                age = current_time - job_time
-                print(f"Job {job_id} age: {age.total_seconds() / 60:.2f} minutes")
-                
-                if age > timedelta(minutes=JOB_EXPIRATION_MINUTES):
-                    print(f"Job {job_id} is {age.total_seconds() / 60:.2f} minutes old, marking for removal")
+            # Pop jobs older than JOB_EXPIRATION_MINUTES off the expiry heap;
+            # only the expired head entries are touched, not every job
+            with app.expiry_lock:
+                while app.expiry_heap and app.expiry_heap[0][0] <= now:
+                    _, job_id = heapq.heappop(app.expiry_heap)
+                    logger.debug("Job %s has expired, marking for removal", job_id)
                     jobs_to_remove.append(job_id)
+                next_expiry = app.expiry_heap[0][0] if app.expiry_heap else None
             
-            # Remove old jobs and their files
-            for job_id in jobs_to_remove:
-                print(f"\nProcessing cleanup for job {job_id}")
-                
-                # Remove job metadata
-                if job_id in app.jobs_metadata:
-                    del app.jobs_metadata[job_id]
-                    print(f"Removed metadata for job {job_id}")
-                
-                # Remove job from queue if present
-                if job_id in app.job_queue:
-                    app.job_queue.remove(job_id)
-                    print(f"Removed job {job_id} from queue")
-                
-                # Remove workspace directory
-                workspace_dir = os.path.join('workspace', job_id)
-                print(f"Checking workspace directory: {workspace_dir}")
-                
-                if os.path.exists(workspace_dir):
-                    # Try to remove the directory with retries
-                    max_retries = 3
-                    for attempt in range(max_retries):
-                        if remove_directory(workspace_dir):
-                            break
-                        print(f"Retry {attempt + 1}/{max_retries} for removing directory {workspace_dir}")
-                        time.sleep(1)  # Wait a second before retrying
-                else:
-                    print(f"Workspace directory {workspace_dir} does not exist")
-                
-                print(f"Completed cleanup for job {job_id}")
+            # Remove old jobs and their files in parallel
+            futures = [app.cleanup_pool.submit(_cleanup_one_job, app, job_id) for job_id in jobs_to_remove]
+            wait(futures)
             
-            print(f"\nCleanup cycle completed. Sleeping for 5 minutes...")
-            time.sleep(300)  # 5 minutes
+            # Sleep until the next job expires, checking at least every 5 minutes
+            sleep_seconds = CLEANUP_INTERVAL_SECONDS
+            if next_expiry is not None:
+                sleep_seconds = min(max(next_expiry - time.time(), 0), CLEANUP_INTERVAL_SECONDS)
+            logger.debug("Cleanup cycle completed. Sleeping for %.0f seconds...", sleep_seconds)
+            time.sleep(sleep_seconds)
             
         except Exception as e:
-            print(f"Error in cleanup thread: {str(e)}")
-            print("Stack trace:", traceback.format_exc())
+            logger.exception("Error in cleanup thread: %s", e)
             time.sleep(60)  # Wait a minute before retrying on error
 
+def append_job_logs(app, job_id, *lines):
+    """Append status lines to a job's log file."""
+    # The container's output handle is in append mode too, so these lines land
+    # between its writes; after cleanup, writing would recreate the file
+    with app.jobs_lock:
+        if job_id not in app.jobs_metadata:
+            return
+        with open(job_log_path(job_id), 'a', encoding='utf-8') as log_file:
+            log_file.write(''.join(f'{line}\n' for line in lines))
+
+def read_job_logs(job_id, since=None):
+    """Return (lines, next_offset) for the complete lines in a job's log file after byte offset since."""
+    # Without since, or if it's more than LOG_WINDOW_BYTES behind, only that
+    # much of the end of the file is read; a trailing partial line waits for
+    # the next call
+    try:
+        fd = os.open(job_log_path(job_id), os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    except FileNotFoundError:
+        return [], since or 0
+    try:
+        size = os.fstat(fd).st_size
+        if since == size:
+            return [], size  # Nothing new, the usual case for a poll
+        window_start = max(size - LOG_WINDOW_BYTES, 0)
+        start = since if since is not None and window_start <= since <= size else window_start
+        # One positioned read on the raw fd, without a buffered file object
+        if hasattr(os, 'pread'):
+            data = os.pread(fd, size - start, start)
+        else:  # Windows
+            os.lseek(fd, start, os.SEEK_SET)
+            data = os.read(fd, size - start)
+    finally:
+        os.close(fd)
+    
+    end = data.rfind(b'\n') + 1  # Up to and including the last complete line
+    first = 0
+    if start != since and start > 0:
+        first = data.find(b'\n', 0, end) + 1  # A tail most likely starts mid-line
+    lines = data[first:end].decode('utf-8', errors='replace').split('\n')[:-1]
+    return lines[-MAX_LOG_LINES:], start + end
+
+def clone_repository(repo_url, branch, workspace_dir, depth=1):
+    """Clone the last depth commits of a branch (all of them for None) and return (success, error message)."""
+    # Jobs only run the tip of the branch, so skip the other branches and
+    # tags; a private or missing repository fails instead of prompting
+    # for credentials
+    cmd = ['git', 'clone', '--single-branch', '--no-tags', '-b', branch]
+    if depth is not None:
+        cmd.append(f'--depth={depth}')
+    try:
+        subprocess.run(
+            [*cmd, repo_url, workspace_dir],
+            check=True,
+            capture_output=True,
+            text=True,
+            timeout=CLONE_TIMEOUT_SECONDS,
+            env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'}
+        )
+        return True, None
+    except subprocess.CalledProcessError as e:
+        return False, e.stderr.strip()
+    except (subprocess.TimeoutExpired, OSError) as e:
+        return False, str(e)
+
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # libyaml's parser when PyYAML has it
+
+@functools.lru_cache(maxsize=256)
+def _parse_job_yaml(yaml_path, mtime_ns, size):
+    """Cached job.yaml parsing keyed on the file's mtime and size."""
+    try:
+        with open(yaml_path, 'rb') as f:
+            config = yaml.load(f, Loader=_YAML_LOADER)
+            return {
+                'web': config.get('web', False),
+                'port': config.get('port', 8000)
+            }
+    except Exception as e:
+        logger.warning("Error parsing job.yaml: %s", e)
+        return {'web': False, 'port': 8000}
+
+def parse_job_yaml(workspace_dir):
+    """Parse job.yaml file and return configuration."""
+    yaml_path = os.path.join(workspace_dir, 'job.yaml')
+    try:
+        stat = os.stat(yaml_path)
+    except OSError:
+        return {'web': False, 'port': 8000}
+    
+    # Copy so callers can't change the cached result
+    return dict(_parse_job_yaml(yaml_path, stat.st_mtime_ns, stat.st_size))
+
+def find_model_file(workspace_dir):
+    """Return the absolute path of a job's model file in models/, or None if it didn't produce one."""
+    try:
+        with os.scandir(os.path.join(workspace_dir, 'models')) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.'):
+                    return os.path.abspath(entry.path)
+    except FileNotFoundError:
+        pass
+    return None
+
 def process_job(app, job_id):
     """Process a single job with resource management."""
+    job = None
     with job_semaphore:
         try:
-            job = app.jobs_metadata.get(job_id)
-            if not job:
-                return
+            with app.jobs_lock:
+                job = app.jobs_metadata.get(job_id)
+                if not job:
+                    return
+                job['status'] = 'Cloning'
+            save_job(app, job)
             
-            print(f"Processing job {job_id}")
-            job['status'] = 'Running'
-            job['start_time'] = datetime.now().timestamp()
+            logger.debug("Processing job %s", job_id)
             
             # Get workspace directory
             workspace_dir = os.path.join('workspace', job_id)
             
+            # The clone happens here rather than in the request, so a slow or
+            # broken repository fails the job instead of holding up /submit
+            cloned, error = clone_repository(job['repo_url'], job['branch'], workspace_dir)
+            if not cloned:
+                with app.jobs_lock:
+                    job['status'] = 'Failed'
+                    set_job_time(job, 'end_time')
+                save_job(app, job)
+                append_job_logs(app, job_id, f"Error cloning repository: {error}")
+                if os.path.exists(workspace_dir) and not discard_directory(workspace_dir):
+                    remove_directory(workspace_dir)
+                logger.info("Job %s failed to clone %s", job_id, job['repo_url'])
+                return
+            
+            # Parse job.yaml configuration
+            job_config = parse_job_yaml(workspace_dir)
+            with app.jobs_lock:
+                job['is_web'] = job_config['web']
+                job['container_port'] = job_config['port']
+                job['status'] = 'Running'
+                set_job_time(job, 'start_time')
+            save_job(app, job)
+            
             # Run the job in Docker
             success, message = run_docker_container(app, job_id, workspace_dir)
             
+            # Record the model file now so downloads don't have to search for it
+            model_path = find_model_file(workspace_dir) if success else None
+            
             # Update job status
-            job['status'] = 'Completed' if success else 'Failed'
-            job['end_time'] = datetime.now().timestamp()
-            job['logs'].append(f"Job {'completed' if success else 'failed'}: {message}")
+            with app.jobs_lock:
+                job['status'] = 'Completed' if success else 'Failed'
+                set_job_time(job, 'end_time')
+                if model_path:
+                    job['model_path'] = model_path
+            save_job(app, job)
+            append_job_logs(app, job_id, f"Job {'completed' if success else 'failed'}: {message}")
             
-            print(f"Job {job_id} {'completed' if success else 'failed'}")
+            logger.info("Job %s %s", job_id, 'completed' if success else 'failed')
             
         except Exception as e:
-            print(f"Error processing job {job_id}: {str(e)}")
+            logger.exception("Error processing job %s: %s", job_id, e)
             if job:
-                job['status'] = 'Failed'
-                job['end_time'] = datetime.now().timestamp()
-                job['logs'].append(f"Job failed with error: {str(e)}")
+                with app.jobs_lock:
+                    job['status'] = 'Failed'
+                    set_job_time(job, 'end_time')
+                save_job(app, job)
+                append_job_logs(app, job_id, f"Job failed with error: {str(e)}")
 
 def background_worker(app):
     """Background thread to manage job queue and parallel execution."""
-    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS) as executor:
-        while True:
-            try:
-                # Process all queued jobs that can be started
-                while app.job_queue and job_semaphore._value > 0:
-                    job_id = app.job_queue.pop(0)
-                    # Submit the job to the thread pool
-                    executor.submit(process_job, app, job_id)
-                
-                time.sleep(1)  # Check queue every second
-                
-            except Exception as e:
-                print(f"Error in background worker: {str(e)}")
-                time.sleep(5)  # Wait 5 seconds before retrying on error
+    while True:
+        try:
+            # Block until a job is submitted, then hand it to the app's
+            # executor so up to MAX_CONCURRENT_JOBS containers run in parallel
+            job_id = app.job_queue.get()
+            
+            # A job cleaned up while still queued is dropped here, so
+            # removing it never requires scanning the queue
+            if job_id not in app.jobs_metadata:
+                logger.debug("Skipping job %s, it was removed while queued", job_id)
+                continue
+            app.executor.submit(process_job, app, job_id)
+            
+        except Exception as e:
+            logger.exception("Error in background worker: %s", e)
+            time.sleep(5)  # Wait 5 seconds before retrying on error
 
 def find_available_port(start_port=9000):
-    """Find an available port starting from start_port."""
+    """Find an available port at or above start_port, letting the kernel pick it."""
     max_attempts = 100  # Prevent infinite loop
-    current_port = start_port
     
     for _ in range(max_attempts):
-        try:
-            # Try to bind to the port
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.bind(('0.0.0.0', current_port))
-                return current_port
-        except OSError:
-            # Port is in use, try Docker port check as well
-            try:
-                # Check if port is used by Docker
-                result = subprocess.run(['docker', 'ps', '--format', '{{.Ports}}'], 
-                                     capture_output=True, text=True, check=True)
-                if str(current_port) not in result.stdout:
-                    # Port might be available for Docker even if not for direct binding
-                    return current_port
-            except subprocess.CalledProcessError:
-                pass  # Ignore Docker check errors
-            
-            # Try next port
-            current_port += 1
+        # Binding to port 0 hands out a free ephemeral port in a single call
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('0.0.0.0', 0))
+            port = s.getsockname()[1]
+        if port >= start_port:
+            return port
     
     raise RuntimeError(f"Could not find an available port after {max_attempts} attempts")
 
+def to_docker_path(path):
+    """Convert an absolute host path to the form Docker expects for volume mounts."""
+    if os.name != 'nt':
+        return path
+    
+    docker_path = path.replace('\\', '/')
+    # Convert drive letter format (e.g., C:/path) to Docker format (/c/path)
+    if docker_path[1] == ':':
+        docker_path = '/' + docker_path[0].lower() + docker_path[2:]
+    return docker_path
+
 def run_docker_container(app, job_id, workspace_dir):
     """Run the job in a Docker container and stream logs."""
     # First check if Docker is running
     if not check_docker_running():
         return False, "Docker daemon is not running. Please start Docker."
     
+    # Hold on to the job's dict itself; cleanup may drop it from
+    # jobs_metadata while the container is still running
+    job = app.jobs_metadata[job_id]
+    
     # Store original Windows path for local operations
     original_workspace_dir = os.path.abspath(workspace_dir)
     
-    # Convert path for Docker only when needed
-    docker_workspace_dir = original_workspace_dir
-    if os.name == 'nt':  # Windows
-        docker_workspace_dir = original_workspace_dir.replace('\\', '/')
-        # Convert drive letter format (e.g., C:/path) to Docker format (/c/path)
-        if docker_workspace_dir[1] == ':':
-            docker_workspace_dir = '/' + docker_workspace_dir[0].lower() + docker_workspace_dir[2:]
+    # The Docker mount path is computed when the job is submitted
+    docker_workspace_dir = job.get('docker_workspace_dir') or to_docker_path(original_workspace_dir)
 
-    print(f"Original workspace directory: {original_workspace_dir}")
-    print(f"Docker workspace directory: {docker_workspace_dir}")
+    logger.debug("Original workspace directory: %s", original_workspace_dir)
+    logger.debug("Docker workspace directory: %s", docker_workspace_dir)
     
-    # List all files in the workspace directory using original path
+    # Read the top-level entries once; framework detection and the
+    # run.sh/main.py/requirements.txt checks below reuse them instead of
+    # issuing separate stat calls
     try:
-        files = os.listdir(original_workspace_dir)
-        print(f"Files in workspace: {files}")
+        with os.scandir(original_workspace_dir) as entries:
+            workspace_files = {entry.name: entry for entry in entries}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Files in workspace: %s", sorted(workspace_files))
     except FileNotFoundError:
         return False, f"Workspace directory not found: {original_workspace_dir}"
     
     # Detect framework and get appropriate base image
-    framework = detect_framework(original_workspace_dir)
+    framework = detect_framework(original_workspace_dir, workspace_files)
     base_image = get_base_image(framework)
-    app.jobs_metadata[job_id]['framework'] = framework
+    job['framework'] = framework
     
     # Create container name
     container_name = f"job_{job_id}"
     
     # Check if this is a web app
-    is_web = app.jobs_metadata[job_id].get('is_web', False)
-    container_port = app.jobs_metadata[job_id].get('container_port', 8000)
+    is_web = job.get('is_web', False)
+    container_port = job.get('container_port', 8000)
     
     # Build Docker command
-    cmd = ['docker', 'run', '--name', container_name]
+    # --rm has the daemon remove the container as soon as it exits
+    cmd = ['docker', 'run', '--pull=missing', '--name', container_name, '--rm']
     
     # Add GPU support based on environment
     is_rocm_available = is_wsl() and has_rocm()
@@ -340,11 +986,11 @@ def run_docker_container(app, job_id, workspace_dir):
             '--cap-add=SYS_PTRACE',  # Required for some ROCm operations
             '--security-opt', 'seccomp=unconfined'  # Required for ROCm in containers
         ])
-        app.jobs_metadata[job_id]['logs'].append("ROCm GPU support enabled")
+        append_job_logs(app, job_id, "ROCm GPU support enabled")
     else:
         # Remove GPU flags if no GPU support is available
         if not is_rocm_available and framework in ['pytorch', 'tensorflow']:
-            app.jobs_metadata[job_id]['logs'].append("Warning: No GPU support detected")
+            append_job_logs(app, job_id, "Warning: No GPU support detected")
     
     # Add volume mount and working directory
     cmd.extend([
@@ -352,28 +998,30 @@ def run_docker_container(app, job_id, workspace_dir):
         '-w', '/app'
     ])
     
-    # Add port mapping for web apps
+    # Reuse pip's wheel cache across runs of the same repository so its
+    # requirements aren't downloaded again. Containers run user code as
+    # root, so each repository gets its own cache and can't plant packages
+    # that another repository's jobs would install
+    pip_cache_dir = pip_cache_path(job['repo_url'])
+    os.makedirs(pip_cache_dir, exist_ok=True)
+    cmd.extend([
+        '-v', f'{to_docker_path(os.path.abspath(pip_cache_dir))}:/root/.cache/pip',
+        '-e', 'PIP_DISABLE_PIP_VERSION_CHECK=1'
+    ])
+    
+    # Add port mapping for web apps; a port that turns out to be taken when
+    # the container starts is retried below with a fresh one
+    port_arg_index = None
     if is_web:
-        max_port_attempts = 5
-        host_port = None
-        last_error = None
-        
-        for attempt in range(max_port_attempts):
-            try:
-                host_port = find_available_port(9000 + attempt * 100)  # Try ports in different ranges
-                # Test Docker port availability explicitly
-                test_cmd = ['docker', 'run', '--rm', '-p', f'{host_port}:{container_port}', 'alpine', 'true']
-                subprocess.run(test_cmd, check=True, capture_output=True)
-                break  # Port is available
-            except (RuntimeError, subprocess.CalledProcessError) as e:
-                last_error = str(e)
-                continue
-        
-        if host_port is None:
-            return False, f"Could not find available port after {max_port_attempts} attempts. Last error: {last_error}"
+        try:
+            host_port = find_available_port(9000)
+        except RuntimeError as e:
+            return False, str(e)
         
-        app.jobs_metadata[job_id]['host_port'] = host_port
-        cmd.extend(['-p', f'{host_port}:{container_port}'])
+        job['host_port'] = host_port
+        cmd.append('-p')
+        port_arg_index = len(cmd)
+        cmd.append(f'{host_port}:{container_port}')
         # Add environment variables for the web app
         cmd.extend([
             '-e', f'PORT={container_port}',
@@ -385,127 +1033,65 @@ def run_docker_container(app, job_id, workspace_dir):
     # Add base image
     cmd.append(base_image)
     
-    # Check for run.sh or main.py using original path
-    if os.path.exists(os.path.join(original_workspace_dir, 'run.sh')):
-        # For web apps, ensure the app binds to 0.0.0.0
-        if is_web:
-            cmd.extend(['bash', '-c', 'tr -d "\\r" < /app/run.sh > /app/run_unix.sh && chmod +x /app/run_unix.sh && (export HOST=0.0.0.0; export PORT=' + str(container_port) + '; export FLASK_RUN_HOST=0.0.0.0; export FLASK_RUN_PORT=' + str(container_port) + '; /app/run_unix.sh)'])
-        else:
-            cmd.extend(['bash', '-c', 'tr -d "\\r" < /app/run.sh > /app/run_unix.sh && chmod +x /app/run_unix.sh && /app/run_unix.sh'])
-    elif os.path.exists(os.path.join(original_workspace_dir, 'main.py')):
-        # Check if requirements.txt exists
-        if os.path.exists(os.path.join(original_workspace_dir, 'requirements.txt')):
-            # Install requirements and run the script
-            if is_web:
-                cmd.extend(['bash', '-c', 'tr -d "\\r" < /app/requirements.txt > /app/requirements_unix.txt && pip install -r /app/requirements_unix.txt && (export HOST=0.0.0.0; export PORT=' + str(container_port) + '; export FLASK_RUN_HOST=0.0.0.0; export FLASK_RUN_PORT=' + str(container_port) + '; python3 -u main.py)'])
-            else:
-                cmd.extend(['bash', '-c', 'tr -d "\\r" < /app/requirements.txt > /app/requirements_unix.txt && pip install -r /app/requirements_unix.txt && python3 -u main.py'])
-        else:
-            # Run the script without installing requirements
-            if is_web:
-                cmd.extend(['bash', '-c', '(export HOST=0.0.0.0; export PORT=' + str(container_port) + '; export FLASK_RUN_HOST=0.0.0.0; export FLASK_RUN_PORT=' + str(container_port) + '; python3 -u main.py)'])
-            else:
-                cmd.extend(['bash', '-c', 'python3 -u main.py'])
+    # Check for run.sh or main.py using original path; each case is an
+    # optional setup step followed by the entrypoint
+    if 'run.sh' in workspace_files:
+        setup = 'tr -d "\\r" < /app/run.sh > /app/run_unix.sh && chmod +x /app/run_unix.sh'
+        entrypoint = '/app/run_unix.sh'
+    elif 'main.py' in workspace_files:
+        # Install requirements first if the repository has them
+        setup = None
+        if 'requirements.txt' in workspace_files:
+            setup = 'tr -d "\\r" < /app/requirements.txt > /app/requirements_unix.txt && pip install -r /app/requirements_unix.txt'
+        entrypoint = 'python3 -u main.py'
     else:
         return False, "No run.sh or main.py found in repository"
     
+    # For web apps, ensure the entrypoint binds to 0.0.0.0
+    if is_web:
+        env_prefix = f'export HOST=0.0.0.0; export PORT={container_port}; export FLASK_RUN_HOST=0.0.0.0; export FLASK_RUN_PORT={container_port}; '
+        entrypoint = f'({env_prefix}{entrypoint})'
+    cmd.extend(['bash', '-c', f'{setup} && {entrypoint}' if setup else entrypoint])
+    
     try:
-        print(f"Starting Docker container with command: {' '.join(cmd)}")
-        app.jobs_metadata[job_id]['logs'].append(f"Starting container with command: {' '.join(cmd)}")
-        
-        # First, check if we need to pull the image
-        inspect_process = subprocess.Popen(
-            ['docker', 'inspect', base_image],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            encoding='utf-8',
-            errors='replace'
-        )
-        inspect_process.wait()
-        
-        if inspect_process.returncode != 0:
-            # Image doesn't exist locally, pull it
-            app.jobs_metadata[job_id]['logs'].append(f"Pulling Docker image: {base_image}")
-            pull_process = subprocess.Popen(
-                ['docker', 'pull', base_image],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                encoding='utf-8',
-                errors='replace',
-                bufsize=1,
-                universal_newlines=True
-            )
+        for attempt in range(MAX_PORT_ATTEMPTS):
+            logger.info("Starting Docker container for job %s: %s", job_id, ' '.join(cmd))
+            append_job_logs(app, job_id, f"Starting container with command: {' '.join(cmd)}")
             
-            # Stream pull logs
-            while True:
-                line = pull_process.stdout.readline()
-                if not line and pull_process.poll() is not None:
-                    break
-                if line:
-                    app.jobs_metadata[job_id]['logs'].append(line.strip())
+            # Run the container with its output going straight to the job's
+            # log file, so no Python code touches it line by line; --pull=missing
+            # lets the daemon fetch the image if needed and the pull progress
+            # ends up in the log along with the job output
+            with open(job_log_path(job_id), 'ab') as log_file:
+                attempt_offset = os.fstat(log_file.fileno()).st_size
+                process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
             
-            pull_process.wait()
-            if pull_process.returncode != 0:
-                return False, f"Failed to pull Docker image: {base_image}"
-        
-        # Run the container
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            encoding='utf-8',
-            errors='replace',
-            bufsize=1,
-            universal_newlines=True
-        )
-        
-        # Stream container logs
-        while True:
-            line = process.stdout.readline()
-            if not line and process.poll() is not None:
+            # Get the exit code
+            exit_code = process.wait()
+            
+            # docker run exits with 125 when the container couldn't be started,
+            # e.g. because another process took the host port in the meantime
+            port_conflict = False
+            if is_web and exit_code == 125:
+                with open(job_log_path(job_id), 'rb') as log_file:
+                    log_file.seek(attempt_offset)
+                    port_conflict = b'port is already allocated' in log_file.read()
+            if not port_conflict or attempt == MAX_PORT_ATTEMPTS - 1:
                 break
-            if line:
-                app.jobs_metadata[job_id]['logs'].append(line.strip())
-                print(f"Container log: {line.strip()}")  # Add console output
-        
-        # Get the exit code
-        exit_code = process.wait()
-        
-        # Check container status
-        try:
-            status_cmd = ['docker', 'inspect', '-f', '{{.State.Status}}', container_name]
-            status = subprocess.run(status_cmd, capture_output=True, text=True, check=True).stdout.strip()
-            app.jobs_metadata[job_id]['logs'].append(f"Container status: {status}")
-            print(f"Container status: {status}")  # Add console output
             
-            if status == 'running':
-                # Get container logs if it's still running
-                logs_cmd = ['docker', 'logs', container_name]
-                logs = subprocess.run(logs_cmd, capture_output=True, text=True, check=True).stdout
-                app.jobs_metadata[job_id]['logs'].append("Container logs:")
-                app.jobs_metadata[job_id]['logs'].extend(logs.splitlines())
-                print("Container logs:")  # Add console output
-                print(logs)  # Add console output
-        except subprocess.CalledProcessError as e:
-            app.jobs_metadata[job_id]['logs'].append(f"Error checking container status: {str(e)}")
-            print(f"Error checking container status: {str(e)}")  # Add console output
+            # Another process grabbed the port between the check and docker run;
+            # ask the kernel for a fresh one, as ephemeral ports aren't sequential
+            subprocess.run(['docker', 'rm', '-f', container_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            host_port = find_available_port(9000)
+            job['host_port'] = host_port
+            cmd[port_arg_index] = f'{host_port}:{container_port}'
+            append_job_logs(app, job_id, f"Host port was already allocated, retrying on port {host_port}")
         
-        # For web apps, we don't remove the container immediately
-        if not is_web:
-            try:
-                subprocess.run(['docker', 'rm', container_name], check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Warning: Failed to remove container {container_name}: {e.stderr}")
+        # An attached docker run only returns once the container has stopped,
+        # so its exit code already is the container's final state
+        job['exit_code'] = exit_code
         
         return exit_code == 0, f"Container exited with code {exit_code}"
         
     except Exception as e:
-        # Try to remove the container if it exists
-        try:
-            subprocess.run(['docker', 'rm', container_name], check=True)
-        except subprocess.CalledProcessError:
-            pass
         return False, f"Error running Docker container: {str(e)}" 
\ No newline at end of file
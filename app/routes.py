@@ -1,71 +1,62 @@
 from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app, jsonify, send_file
 import re
-import subprocess
-from urllib.parse import urlparse
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import quote, urlparse
 import os
 import uuid
+import time
 from datetime import datetime
-from git import Repo
-import shutil
 import tempfile
 import zipfile
-import yaml
 import requests
 from werkzeug.wrappers import Response
-import json
+from app import MAX_LOG_LINES, find_model_file, is_container_running, job_log_path, read_job_logs, save_job, schedule_job_expiry, to_docker_path
 
 main = Blueprint('main', __name__)
 
+_GITHUB_REPO_RE = re.compile(r'https://github\.com/[^/]+/[^/]+/?$')
+XACCEL_LOCATION = '/internal-workspace/'  # nginx internal location aliased to the workspace directory
+PROXY_CHUNK_SIZE = 64 * 1024  # Bytes forwarded at a time from a proxied web app
+EVENTS_POLL_INTERVAL = 0.5  # Seconds between checks of a job's log file for /events
+EVENTS_KEEPALIVE_SECONDS = 15  # Longest an event stream stays silent, so closed connections are noticed
+# Headers that describe one hop of the connection rather than the message;
+# requests recomputes them for the upstream request, and the response body
+# is forwarded decoded and in chunks
+_EXCLUDED_REQUEST_HEADERS = frozenset({'host', 'connection', 'content-length', 'transfer-encoding'})
+_EXCLUDED_RESPONSE_HEADERS = frozenset({'content-encoding', 'content-length', 'transfer-encoding', 'connection'})
+
+# Shared by all proxy requests so connections to job containers are kept alive.
+# Each web app is its own pool, and a pool keeps enough idle connections for
+# every request thread proxying to it at once instead of discarding extras
+_proxy_session = requests.Session()
+_proxy_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=64))
+# The session is shared between visitors, so it must not keep the cookies web
+# apps set; each request forwards only its client's own Cookie header
+_proxy_session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+# The root directory is one level up from the app directory
+_WORKSPACE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'workspace')
+
 def get_workspace_dir():
     """Get the absolute path to the workspace directory."""
-    # Get the root directory (one level up from app directory)
-    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    return os.path.join(root_dir, 'workspace')
+    return _WORKSPACE_DIR
 
-def is_valid_github_url(url):
-    """Validate if the URL is a valid GitHub repository URL."""
-    # Check if URL starts with https://github.com/
-    if not url.startswith('https://github.com/'):
-        return False
-    
-    # Check if URL ends with .git or matches GitHub repo pattern
-    if not (url.endswith('.git') or re.match(r'https://github\.com/[^/]+/[^/]+/?$', url)):
-        return False
+def send_workspace_file(file_path, download_name, mimetype=None):
+    """Send a file from the workspace as an attachment, through nginx when USE_XACCEL is set."""
+    if not current_app.config['USE_XACCEL']:
+        return send_file(file_path, mimetype=mimetype, as_attachment=True,
+                         download_name=download_name, conditional=True)
     
-    return True
+    internal_path = os.path.relpath(file_path, get_workspace_dir()).replace(os.sep, '/')
+    response = Response(mimetype=mimetype or 'application/octet-stream')
+    response.headers['X-Accel-Redirect'] = quote(f'{XACCEL_LOCATION}{internal_path}')
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
 
-def clone_repository(repo_url, branch, job_id):
-    """Clone the repository into the workspace directory."""
-    workspace_dir = os.path.join(get_workspace_dir(), str(job_id))
-    os.makedirs(workspace_dir, exist_ok=True)
-    
-    try:
-        # Clone the repository
-        Repo.clone_from(repo_url, workspace_dir, branch=branch)
-        return True
-    except Exception as e:
-        flash(f'Error cloning repository: {str(e)}', 'error')
-        # Clean up the workspace directory on error
-        if os.path.exists(workspace_dir):
-            shutil.rmtree(workspace_dir)
-        return False
-
-def parse_job_yaml(workspace_dir):
-    """Parse job.yaml file and return configuration."""
-    yaml_path = os.path.join(workspace_dir, 'job.yaml')
-    if not os.path.exists(yaml_path):
-        return {'web': False, 'port': 8000}
-    
-    try:
-        with open(yaml_path, 'r') as f:
-            config = yaml.safe_load(f)
-            return {
-                'web': config.get('web', False),
-                'port': config.get('port', 8000)
-            }
-    except Exception as e:
-        print(f"Error parsing job.yaml: {str(e)}")
-        return {'web': False, 'port': 8000}
+def is_valid_github_url(url):
+    """Validate if the URL is a valid GitHub repository URL."""
+    # https://github.com/<owner>/<repo>, optionally ending in .git or a slash
+    return _GITHUB_REPO_RE.match(url) is not None
 
 @main.route('/')
 def index():
@@ -85,45 +76,32 @@ def submit():
             flash('Please enter a valid GitHub repository URL.', 'error')
             return redirect(url_for('main.submit'))
         
-        # Optional: Check if repository is reachable
-        try:
-            subprocess.run(['git', 'ls-remote', repo_url], 
-                         capture_output=True, 
-                         text=True, 
-                         timeout=5)
-        except subprocess.TimeoutExpired:
-            flash('Repository validation timed out. Please check the URL and try again.', 'error')
-            return redirect(url_for('main.submit'))
-        except subprocess.CalledProcessError:
-            flash('Could not validate repository. Please check if the repository exists and is accessible.', 'error')
-            return redirect(url_for('main.submit'))
-        
         # Generate unique job ID
         job_id = str(uuid.uuid4())
+        workspace_dir = os.path.join('workspace', job_id)
         
-        # Clone the repository
-        if not clone_repository(repo_url, branch, job_id):
-            return redirect(url_for('main.submit'))
-        
-        # Parse job.yaml configuration
-        workspace_dir = os.path.join(get_workspace_dir(), job_id)
-        job_config = parse_job_yaml(workspace_dir)
+        # Store job metadata; the repository is cloned by the job itself, so
+        # the response doesn't wait on the network
+        created_at_ts = time.time()
+        with current_app.jobs_lock:
+            current_app.jobs_metadata[job_id] = {
+                'id': job_id,
+                'repo_url': repo_url,
+                'branch': branch,
+                'status': 'Queued',
+                'timestamp': datetime.fromtimestamp(created_at_ts).isoformat(),
+                'created_at_ts': created_at_ts,
+                'is_web': False,  # Both read from job.yaml once the repository is cloned
+                'container_port': 8000,
+                'host_port': None,  # Will be set when container starts
+                'docker_workspace_dir': to_docker_path(os.path.abspath(workspace_dir))
+            }
         
-        # Store job metadata
-        current_app.jobs_metadata[job_id] = {
-            'id': job_id,
-            'repo_url': repo_url,
-            'branch': branch,
-            'status': 'Queued',
-            'timestamp': datetime.now().isoformat(),
-            'logs': [],
-            'is_web': job_config['web'],
-            'container_port': job_config['port'],
-            'host_port': None  # Will be set when container starts
-        }
+        save_job(current_app, current_app.jobs_metadata[job_id])
+        schedule_job_expiry(current_app, job_id, created_at_ts)
         
         # Add job to queue
-        current_app.job_queue.append(job_id)
+        current_app.job_queue.put(job_id)
         
         flash('Repository submitted successfully!', 'success')
         return redirect(url_for('main.job_status', job_id=job_id))
@@ -132,7 +110,7 @@ def submit():
 
 @main.route('/job/<job_id>')
 def job_status(job_id):
-    job = current_app.jobs_metadata.get(str(job_id))
+    job = current_app.jobs_metadata.get(job_id)
     if not job:
         flash('Job not found.', 'error')
         return redirect(url_for('main.index'))
@@ -145,30 +123,40 @@ def job_status(job_id):
             'end_time': job.get('end_time')
         })
     
-    # Create a copy of the job data for display
-    display_job = job.copy()
-    
-    # Format timestamps if they exist
-    if 'start_time' in display_job:
-        display_job['start_time'] = datetime.fromtimestamp(display_job['start_time']).isoformat()
-    if 'end_time' in display_job:
-        display_job['end_time'] = datetime.fromtimestamp(display_job['end_time']).isoformat()
-    
-    return render_template('job_status.html', job=display_job, job_id=job_id)
+    # Timestamps are formatted when they're set, so the job renders as is
+    # along with the tail of its log file
+    logs, log_offset = read_job_logs(job_id)
+    return render_template('job_status.html', job=job, job_id=job_id, logs=logs,
+                           log_offset=log_offset, max_log_lines=MAX_LOG_LINES)
 
 @main.route('/logs/<job_id>')
 def get_logs(job_id):
-    job = current_app.jobs_metadata.get(str(job_id))
+    job = current_app.jobs_metadata.get(job_id)
     if not job:
         return jsonify({'error': 'Job not found'}), 404
     
-    # Return both logs and status
+    # Only return lines after the client's cursor, a byte offset into the log file
+    logs, next_offset = read_job_logs(job_id, request.args.get('since', type=int))
+    
+    # Return the new logs, the cursor for the next poll and the status
     return jsonify({
-        'logs': job.get('logs', []),
+        'logs': logs,
+        'next': next_offset,
         'status': job.get('status', 'Unknown'),
         'exit_code': job.get('exit_code')
     })
 
+@main.route('/logs/<job_id>/download')
+def download_logs(job_id):
+    """Download the full container output of a job."""
+    job = current_app.jobs_metadata.get(job_id)
+    log_path = os.path.abspath(job_log_path(job_id))
+    if not job or not os.path.exists(log_path):
+        flash('No logs available for download.', 'error')
+        return redirect(url_for('main.index'))
+    
+    return send_workspace_file(log_path, f'{job_id}.log', mimetype='text/plain')
+
 @main.route('/job/<job_id>/status')
 def get_status(job_id):
     job = current_app.jobs_metadata.get(job_id)
@@ -180,43 +168,83 @@ def get_status(job_id):
         'framework': job.get('framework')
     })
 
+@main.route('/events/<job_id>')
+def job_events(job_id):
+    """Stream a job's new log lines and status changes as server-sent events."""
+    # Each event carries the same fields as /logs/<job_id> and uses the log
+    # cursor as its id, so a reconnecting browser resumes where it left off.
+    # A stream holds a worker until the job finishes, so this is meant for
+    # async workers; the job page polls /logs/<job_id> instead
+    job = current_app.jobs_metadata.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    
+    dumps = current_app.json.dumps  # The stream outlives the app context
+    
+    def generate():
+        offset, sent_status = since, None
+        last_sent = time.monotonic()
+        finished = False
+        while True:
+            # The container writes its output straight to the log file, so
+            # the stream checks the file rather than waiting on a signal
+            status = job.get('status', 'Unknown')
+            logs, offset = read_job_logs(job_id, offset)
+            if logs or status != sent_status:
+                data = dumps({
+                    'logs': logs,
+                    'next': offset,
+                    'status': status,
+                    'exit_code': job.get('exit_code')
+                })
+                yield f'id: {offset}\ndata: {data}\n\n'
+                sent_status = status
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= EVENTS_KEEPALIVE_SECONDS:
+                yield ': keepalive\n\n'
+                last_sent = time.monotonic()
+            
+            # Check once more after the job ends for the line it logs last
+            if finished:
+                yield 'event: done\ndata: {}\n\n'
+                return
+            finished = status in ('Completed', 'Failed')
+            time.sleep(EVENTS_POLL_INTERVAL)
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @main.route('/download/<job_id>')
 def download_results(job_id):
     """Download the results of a completed job."""
     try:
-        # Get the workspace directory using the helper function
-        workspace_dir = os.path.join(get_workspace_dir(), str(job_id))
-        models_dir = os.path.join(workspace_dir, 'models')
-        
-        print(f"Looking for models in: {models_dir}")  # Debug log
+        # Jobs record their model file when they finish; otherwise (e.g. a
+        # job restored after a restart) look for it in the models directory
+        job = current_app.jobs_metadata.get(job_id)
+        file_path = job.get('model_path') if job else None
+        if file_path is None:
+            # Get the workspace directory using the helper function
+            workspace_dir = os.path.join(get_workspace_dir(), job_id)
+            current_app.logger.debug("Looking for models in: %s", os.path.join(workspace_dir, 'models'))
+            file_path = find_model_file(workspace_dir)
         
-        # Check if the models directory exists and has files
-        if not os.path.exists(models_dir):
-            print(f"Models directory not found at: {models_dir}")  # Debug log
+        if file_path is None:
+            current_app.logger.debug("No model file found for job %s", job_id)
             flash('No results available for download.', 'error')
             return redirect(url_for('main.job_status', job_id=job_id))
-            
-        # List non-hidden files in the models directory
-        files = [f for f in os.listdir(models_dir) if not f.startswith('.')]
         
-        if not files:
-            print(f"No files found in models directory: {models_dir}")  # Debug log
-            flash('No results available for download.', 'error')
-            return redirect(url_for('main.job_status', job_id=job_id))
-            
-        # Get the first file (assuming one model file per job)
-        file_path = os.path.join(models_dir, files[0])
-        print(f"Attempting to send file: {file_path}")  # Debug log
+        current_app.logger.debug("Attempting to send file: %s", file_path)
         
-        # Send the file
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=files[0]
-        )
+        # Send the file; conditional and range requests are answered, so a
+        # repeated or resumed download doesn't resend the whole model
+        return send_workspace_file(file_path, os.path.basename(file_path))
         
     except Exception as e:
-        print(f"Error downloading results: {str(e)}")
+        current_app.logger.warning("Error downloading results for job %s: %s", job_id, e)
         flash('Error downloading results.', 'error')
         return redirect(url_for('main.job_status', job_id=job_id))
 
@@ -224,7 +252,7 @@ def download_results(job_id):
 @main.route('/site/<job_id>/<path:path>', methods=['GET', 'POST', 'PUT', 'DELETE', 'PATCH'])
 def proxy_web_app(job_id, path):
     """Proxy requests to the web app running in the container."""
-    job = current_app.jobs_metadata.get(str(job_id))
+    job = current_app.jobs_metadata.get(job_id)
     if not job or not job.get('is_web'):
         return "Web app not found", 404
     
@@ -234,60 +262,58 @@ def proxy_web_app(job_id, path):
     
     # Construct the target URL
     target_url = f'http://localhost:{host_port}/{path}'
-    print(f"Proxying request to: {target_url}")
-    print(f"Original request method: {request.method}")
-    print(f"Original request headers: {dict(request.headers)}")
+    current_app.logger.debug("Proxying %s request to: %s", request.method, target_url)
     
     # Forward the request
     try:
         # Get the original request data
-        headers = dict(request.headers)
-        headers.pop('Host', None)  # Remove Host header
+        headers = {name: value for name, value in request.headers.items()
+                   if name.lower() not in _EXCLUDED_REQUEST_HEADERS}
         
         # Add timeout to the request
-        resp = requests.request(
+        resp = _proxy_session.request(
             method=request.method,
             url=target_url,
             headers=headers,
             data=request.get_data(),
-            cookies=request.cookies,
             allow_redirects=False,
+            stream=True,
             timeout=30  # Add timeout
         )
         
-        print(f"Proxy response status: {resp.status_code}")
-        print(f"Proxy response headers: {dict(resp.headers)}")
+        current_app.logger.debug("Proxy response status: %s", resp.status_code)
         
         # Create response
-        excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
         headers = [(name, value) for name, value in resp.raw.headers.items()
-                  if name.lower() not in excluded_headers]
+                   if name.lower() not in _EXCLUDED_RESPONSE_HEADERS]
         
-        response = Response(resp.content, resp.status_code, headers)
+        # Forward the body as it arrives instead of buffering all of it;
+        # closing the upstream response returns its connection to the pool
+        response = Response(resp.iter_content(chunk_size=PROXY_CHUNK_SIZE), resp.status_code, headers)
+        response.call_on_close(resp.close)
         return response
         
     except requests.exceptions.Timeout:
-        print("Proxy request timed out")
+        current_app.logger.debug("Proxy request to %s timed out", target_url)
         return "Request timed out while connecting to the application", 504
     except requests.exceptions.ConnectionError as e:
-        print(f"Connection error: {str(e)}")
-        # Check if container is still running
+        current_app.logger.debug("Proxy connection error: %s", e)
+        # Check if container is still running, preferring the event watcher's view
+        container_name = f"job_{job_id}"
+        running = current_app.running_containers
         try:
-            container_name = f"job_{job_id}"
-            result = subprocess.run(['docker', 'inspect', container_name], 
-                                 capture_output=True, text=True)
-            if result.returncode != 0:
-                return "Container is not running", 503
-            
-            container_info = json.loads(result.stdout)[0]
-            if not container_info['State']['Running']:
-                return "Container is not running", 503
-            
-            # Container is running but not responding
-            return f"Application is running but not responding (port {host_port})", 503
-        except Exception as container_error:
-            print(f"Error checking container: {str(container_error)}")
+            if running is not None:
+                is_running = container_name in running
+            else:
+                is_running = is_container_running(container_name)
+        except OSError as container_error:
+            current_app.logger.warning("Error checking container %s: %s", container_name, container_error)
             return "Error checking application status", 500
+        
+        if not is_running:
+            return "Container is not running", 503
+        # Container is running but not responding
+        return f"Application is running but not responding (port {host_port})", 503
     except requests.exceptions.RequestException as e:
-        print(f"Proxy error: {str(e)}")
+        current_app.logger.debug("Proxy error: %s", e)
         return f"Error proxying request: {str(e)}", 502 
\ No newline at end of file
@@ -1,5 +1,24 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
 from app import create_app
 
+# Log records from the worker, cleanup and job threads are handed to a queue
+# and written by a single listener thread, so none of them block on stderr.
+# INFO by default; set LOG_LEVEL=DEBUG to see per-job cleanup and worker
+# detail. Container output is not logged here; it goes to each job's log file
+log_queue = queue.Queue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+root_logger = logging.getLogger()
+root_logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
 app = create_app()
 
 if __name__ == '__main__':
@@ -13,6 +32,8 @@ if __name__ == '__main__':
     print(f"Network access: http://{local_ip}:5000")
     print(f"Press Ctrl+C to stop the server\n")
     
-    # Run the app on all network interfaces
-    app.run(host='0.0.0.0', port=5000) 
+    # Run the app on all network interfaces; threaded=True is already Flask's
+    # default and is only spelled out because the job page's log stream holds
+    # a request open
+    app.run(host='0.0.0.0', port=5000, threaded=True) 
     #app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file